@@ -3,9 +3,180 @@ import construct
 import hashlib
 import logging
 import macho_cs
+import mmap
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import thread
+import threading
 
 log = logging.getLogger(__name__)
 
+PAGE_SIZE = 0x1000
+
+# Below this many pages, handing the work to other threads costs more
+# than just hashing them here
+MIN_PARALLEL_PAGES = 256
+
+# hashlib uses OpenSSL's EVP digests when Python is linked against it,
+# which picks up SHA extensions (SHA-NI, ARMv8 crypto) where available
+HASH_FUNCTIONS = {macho_cs.SHA1_HASHTYPE: hashlib.sha1,
+                  macho_cs.SHA256_HASHTYPE: hashlib.sha256}
+
+# Pages are hashed in threads, not processes: hashlib releases the GIL
+# while hashing anything over 2 KiB, and threads can share the data
+# without pickling it. Kept around between signings, so we only pay for
+# starting the threads once. False if they couldn't be started.
+_page_hash_pool = None
+# how many threads it has, and so how many runs to split pages into
+_page_hash_pool_threads = None
+# The pid that started the pool. A forked child (e.g. a worker of
+# multisign_archive) inherits the pool but not its threads, so it has to
+# start its own.
+_page_hash_pool_pid = None
+# so threads signing at the same time don't each start a pool
+_page_hash_pool_lock = threading.Lock()
+
+
+def _get_page_hash_pool():
+    """ Get the shared pool and how many threads it has, or (None, None)
+        if this platform can't run one """
+    global _page_hash_pool, _page_hash_pool_threads, _page_hash_pool_pid
+    with _page_hash_pool_lock:
+        pid = os.getpid()
+        if _page_hash_pool is None or _page_hash_pool_pid != pid:
+            _page_hash_pool_pid = pid
+            try:
+                _page_hash_pool_threads = multiprocessing.cpu_count()
+                _page_hash_pool = ThreadPool(_page_hash_pool_threads)
+            except (NotImplementedError, thread.error) as e:
+                # no CPU count, or no more threads to be had
+                log.debug("can't hash pages in parallel: {0}".format(e))
+                _page_hash_pool = False
+        if not _page_hash_pool:
+            return None, None
+        return _page_hash_pool, _page_hash_pool_threads
+
+
+def get_hash_function(hash_type):
+    try:
+        return HASH_FUNCTIONS[hash_type]
+    except KeyError:
+        raise ValueError("unknown hash type %s" % (hash_type,))
+
+
+def _hash_pages(args):
+    """ Hash a contiguous run of pages, writing the digests one after
+        another into out, from out_start. Runs in the pool, so takes a
+        single tuple. """
+    data, hash_type, page_size, out, out_start = args
+    hash_function = get_hash_function(hash_type)
+    digest_size = hash_function().digest_size
+    # hash views of the pages, rather than copying each one out
+    pages = memoryview(data)
+    position = out_start
+    for offset in xrange(0, len(data), page_size):
+        out[position:position + digest_size] = hash_function(pages[offset:offset + page_size]).digest()
+        position += digest_size
+
+
+def hash_pages(data, hash_type, page_size=PAGE_SIZE):
+    """ Get the hashes of every page of data, as used for the code slots
+        of a CodeDirectory, as one bytearray of back to back digests.
+        The last page may be short.
+
+        Large inputs are split into one contiguous run of pages per CPU,
+        and hashed in parallel """
+    digest_size = get_hash_function(hash_type)().digest_size
+    n_pages = (len(data) + page_size - 1) // page_size
+    hashes = bytearray(n_pages * digest_size)
+
+    pool = None
+    if n_pages >= MIN_PARALLEL_PAGES:
+        pool, n_runs = _get_page_hash_pool()
+    if pool is None:
+        _hash_pages((data, hash_type, page_size, hashes, 0))
+        return hashes
+
+    pages_per_run = (n_pages + n_runs - 1) // n_runs
+    run_size = pages_per_run * page_size
+    view = memoryview(data)
+    # each run writes its own part of hashes
+    runs = [(view[start:start + run_size], hash_type, page_size,
+             hashes, (start // page_size) * digest_size)
+            for start in xrange(0, len(data), run_size)]
+    pool.map(_hash_pages, runs)
+    return hashes
+
+
+# Where to find things in a designated requirement that looks like
+#     identifier "..." and anchor apple generic and
+#     certificate leaf[subject.CN] = "..." and ...
+# Strings are attributes, ints are indices into sequences.
+BUNDLE_ID_PATH = ('data', 'expr', 'data', 0, 'data')
+SIGNER_CN_PATH = ('data', 'expr', 'data', 1, 'data', 1, 'data', 0, 'data', 2, 'Data')
+
+
+def find_data_node(node, path):
+    """ Follow path from node, returning the Data container at the end,
+        or None if the structure doesn't match. Checks each step, rather
+        than catching exceptions, as it's often not there. """
+    for step in path:
+        if isinstance(step, int):
+            if not isinstance(node, list) or len(node) <= step:
+                return None
+            node = node[step]
+        else:
+            if not isinstance(node, dict):
+                return None
+            node = node.get(step)
+    if not isinstance(node, dict) or 'data' not in node or 'length' not in node:
+        return None
+    return node
+
+
+def get_codedirectory_parsed_header_size(cd_data):
+    """ How much of the CodeDirectory header construct parses, which goes
+        as far as the last offset field its version has. Newer versions
+        carry on with codeLimit64 and the exec segment fields, which a
+        build would write as zeroes. """
+    if cd_data.version >= 0x20200:
+        return 44  # up to teamIDOffset
+    if cd_data.version >= 0x20100:
+        return 40  # up to scatterOffset
+    return 36
+
+
+def get_codedirectory_header_end(cd_data):
+    """ Where the header ends within the CodeDirectory's bytes, which is
+        wherever the first of the things it points to starts """
+    offsets = [cd_data.identOffset,
+               cd_data.hashOffset - cd_data.hashSize * cd_data.nSpecialSlots]
+    if cd_data.version >= 0x20100 and cd_data.scatterOffset:
+        offsets.append(cd_data.scatterOffset)
+    if cd_data.version >= 0x20200 and cd_data.teamIDOffset:
+        offsets.append(cd_data.teamIDOffset)
+    return min(offsets) - macho_cs.BLOB_HEADER_SIZE
+
+
+def get_blob_bytes(blob):
+    """ A blob's bytes, without its header. Until something reads or
+        replaces them, they're still the OnDemand value from parsing """
+    blob_bytes = blob.bytes
+    if isinstance(blob_bytes, construct.LazyContainer):
+        blob_bytes = blob_bytes.value
+    return blob_bytes
+
+
+def map_file(path):
+    """ Map a file read-only, so it can be hashed without first being
+        copied into a string. Empty files can't be mapped. """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
 # See the documentation for an explanation of how
 # CodeDirectory slots work.
 class CodeDirectorySlot(object):
@@ -16,12 +187,7 @@ class CodeDirectorySlot(object):
         self.codesig = codesig
 
     def get_hash(self, hash_type):
-        if hash_type == macho_cs.SHA1_HASHTYPE:
-            return hashlib.sha1(self.get_contents()).digest()
-        elif hash_type == macho_cs.SHA256_HASHTYPE:
-            return hashlib.sha256(self.get_contents()).digest()
-        else:
-            raise ValueError("unknown hash type %s" % (hash_type,))
+        return get_hash_function(hash_type)(self.get_contents()).digest()
 
 
 class EntitlementsSlot(CodeDirectorySlot):
@@ -44,9 +210,13 @@ class ResourceDirSlot(CodeDirectorySlot):
     def __init__(self, codesig, seal_path):
         super(ResourceDirSlot, self).__init__(codesig)
         self.seal_path = seal_path
+        self.contents = None
 
     def get_contents(self):
-        return open(self.seal_path, "rb").read()
+        # read at most once, however many CodeDirectories need it
+        if self.contents is None:
+            self.contents = map_file(self.seal_path)
+        return self.contents
 
 
 class RequirementsSlot(CodeDirectorySlot):
@@ -61,9 +231,13 @@ class InfoSlot(CodeDirectorySlot):
 
     def __init__(self, info_path):
         self.info_path = info_path
+        self.contents = None
 
     def get_contents(self):
-        return open(self.info_path, "rb").read()
+        # read at most once, however many CodeDirectories need it
+        if self.contents is None:
+            self.contents = map_file(self.info_path)
+        return self.contents
 
 
 class MultipleEntriesException(Exception):
@@ -77,13 +251,22 @@ class Codesig(object):
         self.signable = signable
         self.construct = macho_cs.Blob.parse(data)
 
+        # Signing changes what's in the blobs, but never which blobs
+        # there are, so we can find them all up front
+        self.blobs_by_magic = {}
+        for index in self.construct.data.BlobIndex:
+            if index.blob is not None:
+                self.blobs_by_magic.setdefault(index.blob.magic, []).append(index.blob)
+
     def build_data(self):
-        return macho_cs.Blob.build(self.construct)
+        # unless update_offsets rebuilt it, this is still as parsed
+        superblob = get_blob_bytes(self.construct)
+        # same as Blob.build(self.construct), but without writing the whole
+        # signature through another stream just to read it back out
+        return macho_cs.BlobHeader.build(self.construct) + superblob
 
     def get_blobs(self, magic):
-        return [index.blob
-                for index in self.construct.data.BlobIndex
-                if index.blob.magic == magic]
+        return self.blobs_by_magic.get(magic, [])
 
     def get_blob(self, magic):
         blobs = self.get_blobs(magic)
@@ -112,7 +295,7 @@ class Codesig(object):
             # log.debug(hashlib.sha1(entitlements_data).hexdigest())
 
             entitlements.bytes = entitlements_bytes
-            entitlements.length = len(entitlements_bytes) + 8
+            entitlements.length = len(entitlements_bytes) + macho_cs.BLOB_HEADER_SIZE
             # entitlements_data = macho_cs.Blob_.build(entitlements)
             # log.debug(hashlib.sha1(entitlements_data).hexdigest())
 
@@ -136,41 +319,52 @@ class Codesig(object):
         # we are going to change
         req_blob_0 = requirements.data.BlobIndex[0].blob
         req_blob_0_original_length = req_blob_0.length
+        req_blob_0_changed = False
 
-        if self.signable.get_changed_bundle_id():
+        changed_bundle_id = self.signable.get_changed_bundle_id()
+        if changed_bundle_id:
             # Set the bundle id if it changed
-            try:
-                bundle_struct = req_blob_0.data.expr.data[0].data
-                bundle_struct.data = self.signable.get_changed_bundle_id()
-                bundle_struct.length = len(bundle_struct.data)
-            except Exception:
+            bundle_struct = find_data_node(req_blob_0, BUNDLE_ID_PATH)
+            if bundle_struct is None:
                 log.debug("could not set bundle id")
+            else:
+                bundle_struct.data = changed_bundle_id
+                bundle_struct.length = len(bundle_struct.data)
+                req_blob_0_changed = True
 
-        try:
-            cn = req_blob_0.data.expr.data[1].data[1].data[0].data[2].Data
-        except Exception:
+        cn = find_data_node(req_blob_0, SIGNER_CN_PATH)
+        if cn is None:
             log.debug("no signer CN rule found in requirements")
             log.debug(requirements)
         else:
             # if we could find a signer CN rule, make requirements.
 
             # first, replace old signer CN with our own
-            cn.data = signer_cn
-            cn.length = len(cn.data)
+            if cn.data != signer_cn:
+                cn.data = signer_cn
+                cn.length = len(cn.data)
+                req_blob_0_changed = True
+
+            # Re-signing with the same identity changes nothing, and
+            # the bytes we parsed are still right
+            if not req_blob_0_changed:
+                return
 
             # req_blob_0 contains that CN, so rebuild it, and get what
             # the length is now
             req_blob_0.bytes = macho_cs.Requirement.build(req_blob_0.data)
-            req_blob_0.length = len(req_blob_0.bytes) + 8
+            req_blob_0.length = len(req_blob_0.bytes) + macho_cs.BLOB_HEADER_SIZE
 
             # fix offsets of later blobs in requirements
             offset_delta = req_blob_0.length - req_blob_0_original_length
             for bi in requirements.data.BlobIndex[1:]:
                 bi.offset += offset_delta
 
-            # rebuild requirements, and set length for whole thing
+            # rebuild requirements, and set length for whole thing.
+            # Blobs are emitted from their bytes, so this just joins
+            # req_blob_0's new bytes with the others' existing ones.
             requirements.bytes = macho_cs.Entitlements.build(requirements.data)
-            requirements.length = len(requirements.bytes) + 8
+            requirements.length = len(requirements.bytes) + macho_cs.BLOB_HEADER_SIZE
 
         # then rebuild the whole data, but just to show the digest...?
         # requirements_data = macho_cs.Blob_.build(requirements)
@@ -182,10 +376,16 @@ class Codesig(object):
     def get_codedirectory_hashes(self):
         cd_datas = [(cd, macho_cs.Blob_.build(cd))
                     for cd in self.get_codedirectories()]
-        return [{macho_cs.SHA1_HASHTYPE: hashlib.sha1(data).digest(),
-                 macho_cs.SHA256_HASHTYPE: hashlib.sha256(data).digest(),
-                 'hashType': cd.data.hashType}
-                for cd, data in cd_datas]
+        cd_hashes = []
+        for i, (cd, data) in enumerate(cd_datas):
+            hash_type = cd.data.hashType
+            cd_hash = {hash_type: get_hash_function(hash_type)(data).digest(),
+                       'hashType': hash_type}
+            if i == 0 and macho_cs.SHA256_HASHTYPE not in cd_hash:
+                # the CMS messageDigest is always the SHA256 of the first CD
+                cd_hash[macho_cs.SHA256_HASHTYPE] = hashlib.sha256(data).digest()
+            cd_hashes.append(cd_hash)
+        return cd_hashes
 
     def get_codedirectory_hash_index(self, codedirectory, slot):
         """ The slots have negative offsets, because they start from the 'top'.
@@ -193,55 +393,125 @@ class Codesig(object):
             slots. """
         return slot.offset + codedirectory.data.nSpecialSlots
 
-    def has_codedirectory_slot(self, codedirectory, slot):
-        """ Some dylibs have all 5 slots, even though technically they only need
-            the first 2. If this dylib only has 2 slots, some of the calculated
-            indices for slots will be negative. This means we don't do
-            those slots when resigning (for dylibs, they don't add any
-            security anyway) """
-        return self.get_codedirectory_hash_index(codedirectory, slot) >= 0
-
-    def fill_codedirectory_slot(self, codedirectory, slot):
-        if self.signable.should_fill_slot(self, slot):
-            index = self.get_codedirectory_hash_index(codedirectory, slot)
-            codedirectory.data.hashes[index] = slot.get_hash(codedirectory.data.hashType)
-
+    def set_codedirectory_hash(self, cd_data, index, slot_hash):
+        """ Returns whether the hash actually changed """
+        start = index * cd_data.hashSize
+        if cd_data.hashes[start:start + cd_data.hashSize] == slot_hash:
+            return False
+        # the hashes are parsed as one string; make it writable
+        if not isinstance(cd_data.hashes, bytearray):
+            cd_data.hashes = bytearray(cd_data.hashes)
+        cd_data.hashes[start:start + cd_data.hashSize] = slot_hash
+        return True
+
+    def patch_codedirectory(self, cd, team_id, changed_bundle_id):
+        """ Usually only the hashes change, and maybe the ident or teamID
+            for strings of the same length. Then nothing moves, so we can
+            write those over the bytes we parsed instead of rebuilding the
+            whole CodeDirectory. This also keeps anything construct doesn't
+            parse, like the exec segment fields of newer versions.
+            Returns the new bytes, or None if it has to be rebuilt """
+        cd_data = cd.data
+        if changed_bundle_id and len(changed_bundle_id) != len(cd_data.ident):
+            return None
+        has_team_id = cd_data.version >= 0x20200
+        if has_team_id and (team_id is None or
+                            not cd_data.teamIDOffset or
+                            len(team_id) != len(cd_data.teamID)):
+            return None
+
+        data = bytearray(get_blob_bytes(cd))
+        if changed_bundle_id:
+            start = cd_data.identOffset - macho_cs.BLOB_HEADER_SIZE
+            data[start:start + len(changed_bundle_id)] = changed_bundle_id
+        if has_team_id:
+            start = cd_data.teamIDOffset - macho_cs.BLOB_HEADER_SIZE
+            data[start:start + len(team_id)] = team_id
+        start = (cd_data.hashOffset - cd_data.hashSize * cd_data.nSpecialSlots -
+                 macho_cs.BLOB_HEADER_SIZE)
+        data[start:start + len(cd_data.hashes)] = cd_data.hashes
+        return str(data)
 
     def set_codedirectory(self, seal_path, info_path, signer):
+        # one of each slot, shared by all CodeDirectories, so files are
+        # only read once. Which ones we fill depends on the signable and
+        # signer, not the CodeDirectory, so decide that once too.
+        slots = [ResourceDirSlot(self, seal_path),
+                 RequirementsSlot(self),
+                 ApplicationSlot(self),
+                 InfoSlot(info_path)]
+        if not signer.is_adhoc():
+            slots.insert(0, EntitlementsSlot(self))
+        slots = [slot for slot in slots
+                 if self.signable.should_fill_slot(self, slot)]
+
+        # ids of CodeDirectories with a slot hash that changed
+        hashes_changed = set()
         for cd in self.get_codedirectories():
-            if self.has_codedirectory_slot(cd, EntitlementsSlot) and not signer.is_adhoc():
-                self.fill_codedirectory_slot(cd, EntitlementsSlot(self))
-
-            if self.has_codedirectory_slot(cd, ResourceDirSlot):
-                self.fill_codedirectory_slot(cd, ResourceDirSlot(self, seal_path))
-
-            if self.has_codedirectory_slot(cd, RequirementsSlot):
-                self.fill_codedirectory_slot(cd, RequirementsSlot(self))
-
-            if self.has_codedirectory_slot(cd, ApplicationSlot):
-                self.fill_codedirectory_slot(cd, ApplicationSlot(self))
-
-            if self.has_codedirectory_slot(cd, InfoSlot):
-                self.fill_codedirectory_slot(cd, InfoSlot(info_path))
+            cd_data = cd.data
+            for slot in slots:
+                index = self.get_codedirectory_hash_index(cd, slot)
+                # Some dylibs have all 5 slots, even though technically
+                # they only need the first 2. If this dylib only has 2
+                # slots, some of the calculated indices for slots will be
+                # negative. This means we don't do those slots when
+                # resigning (for dylibs, they don't add any security anyway)
+                if index >= 0:
+                    if self.set_codedirectory_hash(cd_data, index,
+                                                   slot.get_hash(cd_data.hashType)):
+                        hashes_changed.add(id(cd))
+
+        # same for every CodeDirectory, so only look these up once
+        team_id = signer.get_team_id()
+        changed_bundle_id = self.signable.get_changed_bundle_id()
+        log_cdhashes = log.isEnabledFor(logging.DEBUG)
 
         for cd in self.get_codedirectories():
-            cd.data.teamID = signer.get_team_id()
-
-            changed_bundle_id = self.signable.get_changed_bundle_id()
-            if changed_bundle_id:
-                offset_change = len(changed_bundle_id) - len(cd.data.ident)
-                cd.data.ident = changed_bundle_id
-                cd.data.hashOffset += offset_change
-                if cd.data.teamIDOffset is None:
-                    cd.data.teamIDOffset = offset_change
-                else:
-                    cd.data.teamIDOffset += offset_change
-                cd.length += offset_change
-
-            cd.bytes = macho_cs.CodeDirectory.build(cd.data)
+            cd_data = cd.data
+            # older CodeDirectories have no teamID to change
+            team_id_changed = (cd_data.version >= 0x20200 and
+                               cd_data.teamID != team_id)
+            if not (team_id_changed or changed_bundle_id or
+                    id(cd) in hashes_changed):
+                # re-signing with the same identity; the bytes we parsed
+                # are still right
+                continue
+
+            patched = self.patch_codedirectory(cd, team_id, changed_bundle_id)
+            cd_data.teamID = team_id
+
+            if patched is not None:
+                if changed_bundle_id:
+                    cd_data.ident = changed_bundle_id
+                cd.bytes = patched
+            else:
+                original = get_blob_bytes(cd)
+                header_end = get_codedirectory_header_end(cd_data)
+
+                if changed_bundle_id:
+                    offset_change = len(changed_bundle_id) - len(cd_data.ident)
+                    cd_data.ident = changed_bundle_id
+                    cd_data.hashOffset += offset_change
+                    if cd_data.teamIDOffset is None:
+                        cd_data.teamIDOffset = offset_change
+                    else:
+                        cd_data.teamIDOffset += offset_change
+                    cd.length += offset_change
+
+                built = macho_cs.CodeDirectory.build(cd_data)
+                # put back the parts of the header construct doesn't know
+                # about, so they're kept just as when patching
+                header_end = min(header_end, get_codedirectory_header_end(cd_data))
+                parsed_size = get_codedirectory_parsed_header_size(cd_data)
+                if header_end > parsed_size:
+                    built = (built[:parsed_size] +
+                             original[parsed_size:header_end] +
+                             built[header_end:])
+                cd.bytes = built
             # open("cdrip", "wb").write(cd_data)
-            log.debug("CDHash sha1:" + hashlib.sha1(cd.bytes).hexdigest())
-            log.debug("CDHash sha256:" + hashlib.sha256(cd.bytes).hexdigest())
+            if log_cdhashes:
+                log.debug("CDHash sha1:" + hashlib.sha1(cd.bytes).hexdigest())
+                log.debug("CDHash sha256:" + hashlib.sha256(cd.bytes).hexdigest())
 
     def set_signature(self, signer):
         # cds = self.get_codedirectories()
@@ -276,19 +546,27 @@ class Codesig(object):
         sigwrapper.data = construct.Container(data=sig)
         # signer._log_parsed_asn1(sig)
         # sigwrapper.data = construct.Container(data="hahaha")
-        sigwrapper.length = len(sigwrapper.data.data) + 8
+        sigwrapper.length = len(sigwrapper.data.data) + macho_cs.BLOB_HEADER_SIZE
         sigwrapper.bytes = sigwrapper.data.data
         # log.debug(len(sigwrapper.bytes))
 
     def update_offsets(self):
         # update section offsets, to account for any length changes
-        offset = self.construct.data.BlobIndex[0].offset
-        for blob in self.construct.data.BlobIndex:
+        blob_indices = self.construct.data.BlobIndex
+        offset = blob_indices[0].offset
+        for blob in blob_indices:
             blob.offset = offset
-            offset += len(macho_cs.Blob.build(blob.blob))
-
+            # the set_* methods keep length up to date, and building a
+            # blob fails if its bytes don't agree with it, so this is
+            # exactly how much space the blob will take
+            offset += blob.blob.length
+
+        # Blob_ only ever emits a blob's bytes, never its parsed data. Blobs
+        # the set_* methods didn't touch still have the OnDemand bytes from
+        # parsing, so they're copied through from the original signature,
+        # not rebuilt.
         superblob = macho_cs.SuperBlob.build(self.construct.data)
-        self.construct.length = len(superblob) + 8
+        self.construct.length = len(superblob) + macho_cs.BLOB_HEADER_SIZE
         self.construct.bytes = superblob
 
     def resign(self, bundle, signer):
@@ -306,24 +584,3 @@ class Codesig(object):
         self.set_codedirectory(bundle.seal_path, bundle.info_path, signer)
         self.set_signature(signer)
         self.update_offsets()
-
-    # TODO make this optional, in case we want to check hashes or something
-    # log.debug(hashes)
-    # cd = codesig_cons.data.BlobIndex[0].blob.data
-    # end_offset = arch_macho.macho_start + cd.codeLimit
-    # start_offset = ((end_offset + 0xfff) & ~0xfff) - (cd.nCodeSlots * 0x1000)
-
-    # for i in xrange(cd.nSpecialSlots):
-    #    expected = cd.hashes[i]
-    #    log.debug("special exp=%s" % expected.encode('hex'))
-
-    # for i in xrange(cd.nCodeSlots):
-    #     expected = cd.hashes[cd.nSpecialSlots + i]
-    #     f.seek(start_offset + 0x1000 * i)
-    #     actual_data = f.read(min(0x1000, end_offset - f.tell()))
-    #     actual = hashlib.sha1(actual_data).digest()
-    #     log.debug('[%s] exp=%s act=%s' % ()
-    #         ('bad', 'ok ')[expected == actual],
-    #         expected.encode('hex'),
-    #         actual.encode('hex')
-    #     )
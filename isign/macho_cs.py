@@ -27,8 +27,11 @@ class PlistAdapter(Adapter):
 Expr = LazyBound("expr", lambda: Expr_)
 Blob = LazyBound("blob", lambda: Blob_)
 
+# All the hashes, special slots first, as one string of hashSize-byte
+# entries. Big binaries have thousands; keeping them in one buffer means
+# one read or write instead of one per hash.
 Hashes = LazyBound("hashes", lambda: Hashes_)
-Hashes_ = Array(lambda ctx: ctx['nSpecialSlots'] + ctx['nCodeSlots'], Bytes("hash", lambda ctx: ctx['hashSize']))
+Hashes_ = Bytes("hashes", lambda ctx: (ctx['nSpecialSlots'] + ctx['nCodeSlots']) * ctx['hashSize'])
 
 CodeDirectory = Struct("CodeDirectory",
                        Anchor("cd_start"),
@@ -161,18 +164,31 @@ SuperBlob = Struct("SuperBlob",
                    Array(lambda ctx: ctx['count'], BlobIndex),
                    )
 
+BlobMagic = Enum(UBInt32("magic"),
+                 CSMAGIC_REQUIREMENT=0xfade0c00,
+                 CSMAGIC_REQUIREMENTS=0xfade0c01,
+                 CSMAGIC_CODEDIRECTORY=0xfade0c02,
+                 CSMAGIC_ENTITLEMENT=0xfade7171,  # actually, this is kSecCodeMagicEntitlement, and not defined in the C version
+                 CSMAGIC_BLOBWRAPPER=0xfade0b01,  # and this isn't even defined in libsecurity_codesigning; it's in _utilities
+                 CSMAGIC_EMBEDDED_SIGNATURE=0xfade0cc0,
+                 CSMAGIC_DETACHED_SIGNATURE=0xfade0cc1,
+                 CSMAGIC_CODE_SIGN_DRS=0xfade0c05,
+                 _default_=Pass,
+                 )
+
+# Just the start of a Blob; its bytes can be appended without being
+# copied through a construct stream
+BlobHeader = Struct("BlobHeader",
+                    BlobMagic,
+                    UBInt32("length"),
+                    )
+
+# A blob's length, and the offsets in it, count these magic and length
+# bytes too
+BLOB_HEADER_SIZE = BlobHeader.sizeof()
+
 Blob_ = Struct("Blob",
-               Enum(UBInt32("magic"),
-                    CSMAGIC_REQUIREMENT=0xfade0c00,
-                    CSMAGIC_REQUIREMENTS=0xfade0c01,
-                    CSMAGIC_CODEDIRECTORY=0xfade0c02,
-                    CSMAGIC_ENTITLEMENT=0xfade7171,  # actually, this is kSecCodeMagicEntitlement, and not defined in the C version
-                    CSMAGIC_BLOBWRAPPER=0xfade0b01,  # and this isn't even defined in libsecurity_codesigning; it's in _utilities
-                    CSMAGIC_EMBEDDED_SIGNATURE=0xfade0cc0,
-                    CSMAGIC_DETACHED_SIGNATURE=0xfade0cc1,
-                    CSMAGIC_CODE_SIGN_DRS=0xfade0c05,
-                    _default_=Pass,
-                    ),
+               BlobMagic,
                UBInt32("length"),
                Peek(Switch("data", lambda ctx: ctx['magic'],
                            {'CSMAGIC_REQUIREMENT': Requirement,
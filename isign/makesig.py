@@ -7,8 +7,8 @@
 # we may need this someday, so preserving here.
 #
 
+import codesig
 import construct
-import hashlib
 import logging
 import math
 import macho
@@ -123,7 +123,7 @@ def make_basic_codesig(entitlements_file, drs, code_limit, hashes, signer, ident
                                  flags=0,
                                  identOffset=52,
                                  nSpecialSlots=5,
-                                 nCodeSlots=len(hashes),
+                                 nCodeSlots=len(hashes) // len(empty_hash),
                                  codeLimit=code_limit,
                                  hashSize=20,
                                  hashType=1,
@@ -135,7 +135,7 @@ def make_basic_codesig(entitlements_file, drs, code_limit, hashes, signer, ident
                                  teamIDOffset=52 + len(ident) + 1,
                                  teamID=teamID,
                                  hashOffset=52 + (20 * 5) + len(ident) + 1 + len(teamID),
-                                 hashes=([empty_hash] * 5) + hashes,
+                                 hashes=(empty_hash * 5) + hashes,
                                  )
     else:
         teamID = ''
@@ -144,7 +144,7 @@ def make_basic_codesig(entitlements_file, drs, code_limit, hashes, signer, ident
                                  flags=2,
                                  identOffset=52,
                                  nSpecialSlots=5,
-                                 nCodeSlots=len(hashes),
+                                 nCodeSlots=len(hashes) // len(empty_hash),
                                  codeLimit=code_limit,
                                  hashSize=20,
                                  hashType=1,
@@ -156,7 +156,7 @@ def make_basic_codesig(entitlements_file, drs, code_limit, hashes, signer, ident
                                  teamIDOffset=52 + len(ident) + 1,
                                  teamID=teamID,
                                  hashOffset=52 + (20 * 5) + len(ident) + 1 + len(teamID),
-                                 hashes=([empty_hash] * 5) + hashes,
+                                 hashes=(empty_hash * 5) + hashes,
                                  )
 
     cd_data = macho_cs.CodeDirectory.build(cd)
@@ -242,7 +242,7 @@ def make_signature(arch_macho, arch_offset, arch_size, cmds, f, entitlements_fil
 
 
     # generate placeholder LC_CODE_SIGNATURE (like what codesign_allocate does)
-    fake_hashes = ["\x00" * 20]*nCodeSlots
+    fake_hashes = "\x00" * 20 * nCodeSlots
 
     codesig_cons = make_basic_codesig(entitlements_file,
             drs,
@@ -275,7 +275,6 @@ def make_signature(arch_macho, arch_offset, arch_size, cmds, f, entitlements_fil
 
     arch_macho.commands.append(cmd)
 
-    hashes = []
     if codesig_data_length > 0:
         # Patch __LINKEDIT
         for lc in arch_macho.commands:
@@ -307,12 +306,11 @@ def make_signature(arch_macho, arch_offset, arch_size, cmds, f, entitlements_fil
             file_slice += ("\x00" * (bytes_to_read - len(file_slice)))
         actual_data += file_slice
 
-        for i in xrange(nCodeSlots):
-            actual_data_slice = actual_data[(0x1000 * i):(0x1000 * i + 0x1000)]
-
-            actual = hashlib.sha1(actual_data_slice).digest()
-            log.debug("Slot {} (File page @{}): {}".format(i, hex(0x1000 * i), actual.encode('hex')))
-            hashes.append(actual)
+        hashes = codesig.hash_pages(actual_data, macho_cs.SHA1_HASHTYPE)
+        if log.isEnabledFor(logging.DEBUG):
+            for i in xrange(nCodeSlots):
+                actual = str(hashes[20 * i:20 * i + 20])
+                log.debug("Slot {} (File page @{}): {}".format(i, hex(0x1000 * i), actual.encode('hex')))
     else:
         hashes = fake_hashes
 
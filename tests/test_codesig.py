@@ -0,0 +1,316 @@
+import construct
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import thread
+import unittest
+import zipfile
+import isign.bundle
+from isign import codesig, macho_cs
+from isign.macho_cs import SHA1_HASHTYPE, SHA256_HASHTYPE
+from isign.signable import Executable
+from isign_base_test import IsignBaseTest
+
+
+class TestHashPages(unittest.TestCase):
+    def get_data(self, n_pages):
+        # every page different, and a short page at the end
+        return ''.join(chr(i % 256) * codesig.PAGE_SIZE
+                       for i in xrange(n_pages)) + 'tail'
+
+    def get_expected(self, data, hash_function):
+        return ''.join(hash_function(data[i:i + codesig.PAGE_SIZE]).digest()
+                       for i in xrange(0, len(data), codesig.PAGE_SIZE))
+
+    def test_small(self):
+        data = self.get_data(3)
+        self.assertEqual(self.get_expected(data, hashlib.sha1),
+                         codesig.hash_pages(data, SHA1_HASHTYPE))
+        self.assertEqual(self.get_expected(data, hashlib.sha256),
+                         codesig.hash_pages(data, SHA256_HASHTYPE))
+
+    def test_parallel(self):
+        data = self.get_data(codesig.MIN_PARALLEL_PAGES + 7)
+        self.assertEqual(self.get_expected(data, hashlib.sha256),
+                         codesig.hash_pages(data, SHA256_HASHTYPE))
+
+    def test_no_pool(self):
+        """ platforms that can't start a pool still get the right hashes """
+        def broken_pool(*args):
+            # what starting a thread raises when there are none to be had
+            raise thread.error("can't start new thread")
+
+        old_pool_class = codesig.ThreadPool
+        old_pool = codesig._page_hash_pool
+        try:
+            codesig.ThreadPool = broken_pool
+            codesig._page_hash_pool = None
+            data = self.get_data(codesig.MIN_PARALLEL_PAGES + 7)
+            self.assertEqual(self.get_expected(data, hashlib.sha1),
+                             codesig.hash_pages(data, SHA1_HASHTYPE))
+        finally:
+            codesig.ThreadPool = old_pool_class
+            codesig._page_hash_pool = old_pool
+
+    def test_no_cpu_count(self):
+        """ nor do platforms that can't count their CPUs """
+        def broken_cpu_count():
+            raise NotImplementedError('cannot determine number of cpus')
+
+        old_cpu_count = multiprocessing.cpu_count
+        old_pool = codesig._page_hash_pool
+        try:
+            multiprocessing.cpu_count = broken_cpu_count
+            codesig._page_hash_pool = None
+            data = self.get_data(codesig.MIN_PARALLEL_PAGES + 7)
+            self.assertEqual(self.get_expected(data, hashlib.sha1),
+                             codesig.hash_pages(data, SHA1_HASHTYPE))
+        finally:
+            multiprocessing.cpu_count = old_cpu_count
+            codesig._page_hash_pool = old_pool
+
+    def test_forked_child(self):
+        """ a child forked after the parent started the pool must not try
+            to use the parent's threads, which it doesn't have """
+        data = self.get_data(codesig.MIN_PARALLEL_PAGES + 7)
+        expected = self.get_expected(data, hashlib.sha1)
+        self.assertEqual(expected, codesig.hash_pages(data, SHA1_HASHTYPE))
+        pool = multiprocessing.Pool(1)
+        try:
+            result = pool.apply_async(codesig.hash_pages, (data, SHA1_HASHTYPE))
+            self.assertEqual(expected, result.get(timeout=30))
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def test_bad_hash_type(self):
+        with self.assertRaises(ValueError):
+            codesig.hash_pages('data', 99)
+
+
+class TestMapFile(unittest.TestCase):
+    def test_map_file(self):
+        for contents in ['', 'some plist data']:
+            fd, path = tempfile.mkstemp()
+            try:
+                os.write(fd, contents)
+                os.close(fd)
+                mapped = codesig.map_file(path)
+                self.assertEqual(contents, mapped[:])
+                self.assertEqual(hashlib.sha256(contents).digest(),
+                                 hashlib.sha256(mapped).digest())
+            finally:
+                os.remove(path)
+
+
+class TestCodeDirectoryHeader(unittest.TestCase):
+    def get_cd_data(self, version, **offsets):
+        cd_data = construct.Container(version=version,
+                                      identOffset=100,
+                                      hashOffset=200,
+                                      hashSize=20,
+                                      nSpecialSlots=5)
+        cd_data.update(offsets)
+        return cd_data
+
+    def test_parsed_header_size(self):
+        self.assertEqual(36, codesig.get_codedirectory_parsed_header_size(
+            self.get_cd_data(0x20001)))
+        self.assertEqual(40, codesig.get_codedirectory_parsed_header_size(
+            self.get_cd_data(0x20100, scatterOffset=0)))
+        self.assertEqual(44, codesig.get_codedirectory_parsed_header_size(
+            self.get_cd_data(0x20400, scatterOffset=0, teamIDOffset=150)))
+
+    def test_header_end(self):
+        self.assertEqual(92, codesig.get_codedirectory_header_end(
+            self.get_cd_data(0x20001)))
+        # anything the header points to can come first
+        self.assertEqual(82, codesig.get_codedirectory_header_end(
+            self.get_cd_data(0x20100, scatterOffset=90)))
+        self.assertEqual(72, codesig.get_codedirectory_header_end(
+            self.get_cd_data(0x20400, scatterOffset=0, teamIDOffset=80)))
+        self.assertEqual(82, codesig.get_codedirectory_header_end(
+            self.get_cd_data(0x20200, scatterOffset=0, teamIDOffset=300,
+                             hashOffset=190)))
+
+
+class StubSigner(object):
+    def __init__(self, common_name, team_id=None):
+        self.common_name = common_name
+        self.team_id = team_id
+
+    def is_adhoc(self):
+        return False
+
+    def get_common_name(self):
+        return self.common_name
+
+    def get_team_id(self):
+        return self.team_id
+
+
+class StubSignable(object):
+    """ A real signable, but pretending its bundle id changed """
+    def __init__(self, signable, changed_bundle_id):
+        self.signable = signable
+        self.changed_bundle_id = changed_bundle_id
+
+    def should_fill_slot(self, codesig, slot):
+        return self.signable.should_fill_slot(codesig, slot)
+
+    def get_changed_bundle_id(self):
+        return self.changed_bundle_id
+
+
+class CodesigTest(IsignBaseTest):
+    """ For tests that work on the code signature of a real app """
+    def get_executable(self, app_path=None):
+        self.bundle = isign.bundle.IosApp(app_path or self.TEST_APP_XCODE7)
+        return Executable(self.bundle, self.bundle.get_executable_path(), None)
+
+    def get_codesig(self, app_path=None):
+        return self.get_executable(app_path).arches[0]['codesig']
+
+
+class TestSetRequirements(CodesigTest):
+    def get_requirements_data(self, codesig):
+        return macho_cs.Blob_.build(codesig.get_blob('CSMAGIC_REQUIREMENTS'))
+
+    def get_signer_cn(self, codesig):
+        requirements = codesig.get_blob('CSMAGIC_REQUIREMENTS')
+        expr = requirements.data.BlobIndex[0].blob.data.expr
+        return expr.data[1].data[1].data[0].data[2].Data.data
+
+    def test_find_data_node(self):
+        signature = self.get_codesig()
+        requirements = signature.get_blob('CSMAGIC_REQUIREMENTS')
+        req_blob_0 = requirements.data.BlobIndex[0].blob
+        self.assertEqual(self.get_signer_cn(signature),
+                         codesig.find_data_node(req_blob_0, codesig.SIGNER_CN_PATH).data)
+        # anything that isn't shaped right just isn't found
+        self.assertIsNone(codesig.find_data_node(req_blob_0, ('data', 'expr', 'data', 99)))
+        self.assertIsNone(codesig.find_data_node(req_blob_0, ('data', 'kind', 'data')))
+        self.assertIsNone(codesig.find_data_node(req_blob_0, ('data', 'expr')))
+
+    def test_same_signer(self):
+        codesig = self.get_codesig()
+        original = self.get_requirements_data(codesig)
+        codesig.set_requirements(StubSigner(self.get_signer_cn(codesig)))
+        self.assertEqual(original, self.get_requirements_data(codesig))
+
+    def test_new_signer(self):
+        codesig = self.get_codesig()
+        original = self.get_requirements_data(codesig)
+        codesig.set_requirements(StubSigner('Someone Else Entirely'))
+        self.assertEqual('Someone Else Entirely', self.get_signer_cn(codesig))
+        new = self.get_requirements_data(codesig)
+        self.assertNotEqual(original, new)
+        requirements = codesig.get_blob('CSMAGIC_REQUIREMENTS')
+        self.assertEqual(len(new), requirements.length)
+
+
+class TestUpdateOffsets(CodesigTest):
+    def test_unchanged_codesig(self):
+        """ with nothing changed, we should write the signature we read """
+        executable = self.get_executable()
+        for arch in executable.arches:
+            lc_codesig = arch['lc_codesig'].data
+            executable.f.seek(arch['macho'].macho_start + lc_codesig.dataoff)
+            original = executable.f.read(lc_codesig.datasize)
+
+            arch['codesig'].update_offsets()
+            data = arch['codesig'].build_data()
+            self.assertEqual(original[:len(data)], data)
+            # the rest is just padding
+            self.assertEqual('', original[len(data):].strip('\x00'))
+
+
+class TestCodeDirectoryHashes(CodesigTest):
+    def test_get_codedirectory_hashes(self):
+        """ each CD only gets its own hash type, except the first, which
+            also needs a SHA256 for the CMS messageDigest """
+        signature = self.get_codesig()
+        cds = signature.get_codedirectories()
+        cd_hashes = signature.get_codedirectory_hashes()
+        self.assertEqual(len(cds), len(cd_hashes))
+        for i, (cd, cd_hash) in enumerate(zip(cds, cd_hashes)):
+            hash_type = cd.data.hashType
+            data = macho_cs.Blob_.build(cd)
+            self.assertEqual(hash_type, cd_hash['hashType'])
+            self.assertEqual(codesig.get_hash_function(hash_type)(data).digest(),
+                             cd_hash[hash_type])
+            expected_keys = set(['hashType', hash_type])
+            if i == 0:
+                self.assertEqual(hashlib.sha256(data).digest(),
+                                 cd_hash[SHA256_HASHTYPE])
+                expected_keys.add(SHA256_HASHTYPE)
+            self.assertEqual(expected_keys, set(cd_hash.keys()))
+
+
+class TestSetCodeDirectory(CodesigTest):
+    def set_codedirectory(self, signature, team_id):
+        seal_path = os.path.join(self.bundle.path, '_CodeSignature', 'CodeResources')
+        signer = StubSigner(None, team_id)
+        signature.set_codedirectory(seal_path, self.bundle.info_path, signer)
+
+    def test_same_identity(self):
+        """ nothing changed, so the CodeDirectory isn't rebuilt """
+        signature = self.get_codesig()
+        cd = signature.get_codedirectories()[0]
+        original = cd.bytes
+        self.set_codedirectory(signature, cd.data.teamID)
+        self.assertIs(original, cd.bytes)
+
+    def test_new_team_id(self):
+        signature = self.get_codesig()
+        cd = signature.get_codedirectories()[0]
+        original = cd.bytes
+        self.set_codedirectory(signature, 'ABCDE12345')
+        self.assertNotEqual(original, cd.bytes)
+        self.assertEqual('ABCDE12345', macho_cs.CodeDirectory.parse(cd.bytes).teamID)
+        # same length, so it was patched in place; should be just what
+        # a full build would give
+        self.assertEqual(macho_cs.CodeDirectory.build(cd.data), cd.bytes)
+
+    def test_new_team_id_length(self):
+        """ strings that change length move things, so it gets rebuilt """
+        signature = self.get_codesig()
+        cd = signature.get_codedirectories()[0]
+        self.assertIsNone(signature.patch_codedirectory(cd, 'SHORT', None))
+        self.set_codedirectory(signature, 'SHORT')
+        self.assertEqual('SHORT', macho_cs.CodeDirectory.parse(cd.bytes).teamID)
+
+    def test_new_bundle_id(self):
+        """ an ident of the same length is also patched in place """
+        signature = self.get_codesig()
+        cd = signature.get_codedirectories()[0]
+        original_length = cd.length
+        bundle_id = cd.data.ident[::-1]
+        self.assertNotEqual(cd.data.ident, bundle_id)
+        signature.signable = StubSignable(signature.signable, bundle_id)
+        self.assertIsNotNone(signature.patch_codedirectory(cd, cd.data.teamID, bundle_id))
+        self.set_codedirectory(signature, cd.data.teamID)
+        self.assertEqual(bundle_id, macho_cs.CodeDirectory.parse(cd.bytes).ident)
+        self.assertEqual(original_length, cd.length)
+        self.assertEqual(macho_cs.CodeDirectory.build(cd.data), cd.bytes)
+
+    def test_rebuild_keeps_header(self):
+        """ rebuilding keeps the header fields construct doesn't parse,
+            same as patching does """
+        temp_dir = self.get_temp_dir()
+        try:
+            zipfile.ZipFile(self.TEST_IPA_XCODE11).extractall(temp_dir)
+            signature = self.get_codesig(os.path.join(temp_dir, 'Payload', 'IsignTestApp.app'))
+            cd = signature.get_codedirectories()[0]
+            parsed_size = codesig.get_codedirectory_parsed_header_size(cd.data)
+            header_end = codesig.get_codedirectory_header_end(cd.data)
+            original_header = codesig.get_blob_bytes(cd)[parsed_size:header_end]
+            # the exec segment fields, at least, aren't all zeroes
+            self.assertNotEqual('', original_header.strip('\x00'))
+            self.set_codedirectory(signature, 'SHORT')
+            self.assertEqual('SHORT', macho_cs.CodeDirectory.parse(cd.bytes).teamID)
+            self.assertEqual(original_header,
+                             cd.bytes[parsed_size:header_end])
+        finally:
+            self.unlink(temp_dir)